@@ -5,8 +5,11 @@ This solves the network connectivity issue between Docker and external broker
 """
 
 import json
+import logging
 import os
-import time
+import signal
+import socket
+import threading
 import sys
 from datetime import datetime
 
@@ -26,6 +29,49 @@ EXTERNAL_USER = os.getenv("EXTERNAL_BROKER_USER", "")
 EXTERNAL_PASS = os.getenv("EXTERNAL_BROKER_PASS", "")
 LOCAL_USER = os.getenv("LOCAL_BROKER_USER", "")
 LOCAL_PASS = os.getenv("LOCAL_BROKER_PASS", "")
+# QoS used when republishing locally - 0 avoids a PUBACK round-trip per forward
+FORWARD_QOS = int(os.getenv("FORWARD_QOS", "0"))
+MQTT_DEBUG = bool(os.getenv("MQTT_DEBUG", ""))
+# Optional scheduling: pin to CPU cores (e.g. "3" or "2,3") and adjust niceness
+BRIDGE_CPUS = os.getenv("BRIDGE_CPUS", "")
+BRIDGE_NICE = os.getenv("BRIDGE_NICE", "")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+HEARTBEAT_INTERVAL = 60.0  # seconds between forwarding summaries
+
+logger = logging.getLogger("mqtt_bridge")
+
+SOCKET_BUFFER_SIZE = 1 << 20  # 1 MiB kernel send/receive buffers
+
+def tune_socket(sock):
+    """Send small forwards immediately and give bursts room in the kernel buffers"""
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    except OSError as e:
+        print(f"⚠️  Could not tune socket options: {e}")
+
+def apply_scheduling():
+    """Pin the process to BRIDGE_CPUS and apply BRIDGE_NICE, if configured"""
+    if BRIDGE_CPUS:
+        try:
+            cpus = {int(cpu) for cpu in BRIDGE_CPUS.split(",") if cpu.strip()}
+            os.sched_setaffinity(0, cpus)
+            print(f"📌 Pinned to CPU(s) {sorted(cpus)}")
+        except (AttributeError, OSError, ValueError) as e:
+            print(f"⚠️  Could not set CPU affinity: {e}")
+    
+    if BRIDGE_NICE:
+        try:
+            increment = int(BRIDGE_NICE)
+            if increment:
+                os.nice(increment)
+                print(f"📌 Niceness adjusted by {increment}")
+        except (OSError, ValueError) as e:
+            # Raising priority needs CAP_SYS_NICE
+            print(f"⚠️  Could not adjust niceness: {e}")
 
 class MQTTBridge:
     def __init__(self):
@@ -34,11 +80,17 @@ class MQTTBridge:
         self.connected_to_external = False
         self.connected_to_local = False
         self.running = False
+        self._stop_event = threading.Event()
+        self._ext_ready = threading.Event()
+        self._loc_ready = threading.Event()
+        self._counts = [0, 0]  # forwarded, failed - written only by the external network thread
         
     def on_external_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             print(f"✅ Connected to external broker {EXTERNAL_BROKER}:{EXTERNAL_PORT}")
             self.connected_to_external = True
+            tune_socket(client.socket())
+            self._ext_ready.set()
             # Subscribe to all sensor topics
             client.subscribe(TOPIC_FILTER, qos=1)
             print(f"📡 Subscribed to {TOPIC_FILTER}")
@@ -46,7 +98,7 @@ class MQTTBridge:
             print(f"❌ Failed to connect to external broker, return code {rc}")
             self.connected_to_external = False
     
-    def on_external_disconnect(self, client, userdata, rc, properties=None):
+    def on_external_disconnect(self, client, userdata, disconnect_flags, rc, properties=None):
         self.connected_to_external = False
         if rc != 0:
             print(f"⚠️  External broker disconnected, return code: {rc}")
@@ -55,30 +107,68 @@ class MQTTBridge:
         else:
             print("🔌 Disconnected from external broker")
     
-    def on_external_message(self, client, userdata, msg):
-        """Forward message from external broker to local broker"""
-        if self.connected_to_local:
-            try:
-                # Forward the message to local broker
-                result = self.local_client.publish(msg.topic, msg.payload, qos=msg.qos, retain=msg.retain)
-                if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                    print(f"📤 Forwarded: {msg.topic} -> {LOCAL_BROKER}")
+    def make_forwarder(self):
+        """Build the on_message callback that forwards to the local broker.
+        
+        This runs once per message, so it keeps the work to a single publish:
+        the bound method is captured as a local and results are only counted
+        here, then logged by report_stats.
+        """
+        local_publish = self.local_client.publish
+        counts = self._counts
+        success = mqtt.MQTT_ERR_SUCCESS
+        qos = FORWARD_QOS
+        
+        def forward(client, userdata, msg):
+            # The external broker holds the reliable copy; with FORWARD_QOS > 0
+            # paho also queues the publish while the local broker reconnects
+            if local_publish(msg.topic, msg.payload, qos, msg.retain).rc == success:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+        
+        return forward
+    
+    def report_stats(self):
+        """Log forwarding counters until the bridge stops.
+        
+        Runs on the main thread. Per-second deltas are only logged at DEBUG;
+        otherwise it wakes once per HEARTBEAT_INTERVAL to log a summary.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        interval = 1.0 if debug else HEARTBEAT_INTERVAL
+        ticks_per_beat = max(1, round(HEARTBEAT_INTERVAL / interval))
+        reported = beat = [0, 0]
+        ticks = 0
+        while not self._stop_event.wait(interval):
+            current = list(self._counts)
+            if debug and current != reported:
+                logger.debug("Forwarded %d, failed %d -> %s",
+                             current[0] - reported[0], current[1] - reported[1], LOCAL_BROKER)
+            reported = current
+            
+            ticks += 1
+            if ticks % ticks_per_beat == 0:
+                forwarded, failed = current[0] - beat[0], current[1] - beat[1]
+                beat = current
+                if failed:
+                    logger.warning("Bridge running, forwarded %d msgs, %d failed in last %.0fs",
+                                   forwarded, failed, HEARTBEAT_INTERVAL)
                 else:
-                    print(f"❌ Failed to forward message: {result.rc}")
-            except Exception as e:
-                print(f"❌ Error forwarding message: {e}")
-        else:
-            print("⚠️  Local broker not connected, dropping message")
+                    logger.info("Bridge running, forwarded %d msgs in last %.0fs",
+                                forwarded, HEARTBEAT_INTERVAL)
     
     def on_local_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             print(f"✅ Connected to local broker {LOCAL_BROKER}:{LOCAL_PORT}")
             self.connected_to_local = True
+            tune_socket(client.socket())
+            self._loc_ready.set()
         else:
             print(f"❌ Failed to connect to local broker, return code {rc}")
             self.connected_to_local = False
     
-    def on_local_disconnect(self, client, userdata, rc, properties=None):
+    def on_local_disconnect(self, client, userdata, disconnect_flags, rc, properties=None):
         self.connected_to_local = False
         if rc != 0:
             print(f"⚠️  Local broker disconnected, return code: {rc}")
@@ -95,7 +185,6 @@ class MQTTBridge:
                                          clean_session=False)
         self.external_client.on_connect = self.on_external_connect
         self.external_client.on_disconnect = self.on_external_disconnect
-        self.external_client.on_message = self.on_external_message
         
         # Add authentication for external broker if provided
         if EXTERNAL_USER and EXTERNAL_PASS:
@@ -107,21 +196,31 @@ class MQTTBridge:
                                       clean_session=False)
         self.local_client.on_connect = self.on_local_connect
         self.local_client.on_disconnect = self.on_local_disconnect
+        self.external_client.on_message = self.make_forwarder()
+        
+        # Don't serialize QoS 1/2 forwards behind the default 20 in-flight slots
+        self.local_client.max_inflight_messages_set(1024)
         
         # Add authentication for local broker if provided
         if LOCAL_USER and LOCAL_PASS:
             self.local_client.username_pw_set(LOCAL_USER, LOCAL_PASS)
         
-        # Enable auto-reconnect
-        self.external_client.enable_logger()
-        self.local_client.enable_logger()
+        # Let paho's network threads reconnect with exponential backoff
+        self.external_client.reconnect_delay_set(min_delay=1, max_delay=60)
+        self.local_client.reconnect_delay_set(min_delay=1, max_delay=60)
+        
+        # Opt-in: with it on, both clients log every forwarded message twice
+        if MQTT_DEBUG:
+            self.external_client.enable_logger()
+            self.local_client.enable_logger()
     
     def connect_clients(self):
         """Connect both clients with retry logic"""
         # Connect to external broker
         try:
             print(f"Connecting to external broker {EXTERNAL_BROKER}:{EXTERNAL_PORT}...")
-            self.external_client.connect(EXTERNAL_BROKER, EXTERNAL_PORT, keepalive=60)
+            # Connect from the network thread so an unreachable broker can't block startup
+            self.external_client.connect_async(EXTERNAL_BROKER, EXTERNAL_PORT, keepalive=60)
             self.external_client.loop_start()
         except Exception as e:
             print(f"❌ External broker connection error: {e}")
@@ -149,6 +248,7 @@ class MQTTBridge:
         print("Press Ctrl+C to stop...")
         print()
         
+        apply_scheduling()
         self.running = True
         
         try:
@@ -160,46 +260,40 @@ class MQTTBridge:
                 print("❌ Failed to connect to brokers")
                 return False
             
-            # Wait for connections
-            time.sleep(3)
-            
-            if not self.connected_to_external:
+            # Wait for both CONNACKs rather than a fixed delay
+            if not self._ext_ready.wait(10):
                 print("❌ Failed to connect to external broker")
                 return False
             
-            if not self.connected_to_local:
+            if not self._loc_ready.wait(10):
                 print("❌ Failed to connect to local broker")
                 return False
             
+            # request_stop also releases the waits above
+            if self._stop_event.is_set():
+                print("\n🛑 Stopping bridge...")
+                return False
+            
             print("✅ Bridge is running! Forwarding messages...")
             
-            # Keep running with connection monitoring
-            while self.running:
-                # Check connection status and reconnect if needed
-                if not self.connected_to_external:
-                    print("🔄 Reconnecting to external broker...")
-                    try:
-                        self.external_client.reconnect()
-                    except Exception as e:
-                        print(f"❌ External reconnection failed: {e}")
-                
-                if not self.connected_to_local:
-                    print("🔄 Reconnecting to local broker...")
-                    try:
-                        self.local_client.reconnect()
-                    except Exception as e:
-                        print(f"❌ Local reconnection failed: {e}")
-                
-                time.sleep(5)  # Check every 5 seconds
-                
-        except KeyboardInterrupt:
+            # The main thread reports stats until signalled; forwarding and
+            # reconnects happen in paho's network threads
+            self.report_stats()
             print("\n🛑 Stopping bridge...")
+                
         except Exception as e:
             print(f"❌ Error: {e}")
         finally:
             self.running = False
             self.stop()
     
+    def request_stop(self, signum=None, frame=None):
+        """Signal handler - wake the main thread so it can shut down"""
+        self._stop_event.set()
+        # Don't leave start() waiting out the CONNACK timeouts
+        self._ext_ready.set()
+        self._loc_ready.set()
+    
     def stop(self):
         """Stop the MQTT bridge"""
         if self.external_client:
@@ -211,7 +305,10 @@ class MQTTBridge:
         print("✅ Bridge stopped")
 
 def main():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     bridge = MQTTBridge()
+    signal.signal(signal.SIGINT, bridge.request_stop)
+    signal.signal(signal.SIGTERM, bridge.request_stop)
     bridge.start()
 
 if __name__ == "__main__":
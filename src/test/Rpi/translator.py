@@ -4,16 +4,20 @@ Raspberry Pi MQTT Test Translator (single-file)
 - Robust broker discovery (localhost -> common hostnames -> optional LAN scan)
 - Paho-MQTT v2 callback API (no deprecation warnings)
 - Waits for connection before first publish (avoids rc=4 "no connection")
+- Single asyncio event loop drives paho's socket (no background network thread),
+  running on uvloop when it is installed
 - Clean shutdown on Ctrl+C
 """
 
 import os
 import sys
 import time
+import asyncio
 import json
 import random
 import socket
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 try:
@@ -22,25 +26,96 @@ except ImportError:
     print("❌ paho-mqtt not installed. Install with: pip install paho-mqtt")
     sys.exit(1)
 
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    # Same compact bytes output as orjson, so payload splicing is unchanged
+    def _dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+try:
+    import uvloop
+except ImportError:
+    # main() runs on asyncio.run instead
+    uvloop = None
+
+try:
+    import numpy as np
+except ImportError:
+    # generate_readings() uses the random module without it
+    np = None
+
 # Configuration
 PI_ID = "pi_K001"
 DEVICE_ID = "10000"
-TOPIC = f"sensors/{PI_ID}/{DEVICE_ID}/reading"
+DEVICE_IDS = [DEVICE_ID]  # all devices are multiplexed over one MQTT client
+TOPIC_TEMPLATE = "sensors/{pi_id}/{device_id}/reading"
 
 # Test data
 BASE_TEMP = 22.0
 TEMP_VARIATION = 2.0
+RANDOM_BATCH = 4096  # readings generated per refill of the random buffer
+
+# Batching - buffered readings are published back-to-back as separate messages
+BATCH_SIZE = 32
+FLUSH_INTERVAL = 10.0  # seconds before a partial batch is sent anyway
+
+def generate_readings(n, rng=None):
+    """Pre-generate n rounded [temperature, humidity, battery] readings
+    
+    rng is a numpy Generator; without one the random module is used.
+    """
+    if rng is not None:
+        values = rng.uniform(
+            [BASE_TEMP - TEMP_VARIATION, 40, 85],
+            [BASE_TEMP + TEMP_VARIATION, 70, 100],
+            size=(n, 3),
+        )
+        values[:, 0] = values[:, 0].round(2)
+        values[:, 1:] = values[:, 1:].round(1)
+        return values.tolist()
+    return [
+        [round(BASE_TEMP + random.uniform(-TEMP_VARIATION, TEMP_VARIATION), 2),
+         round(random.uniform(40, 70), 1),
+         round(random.uniform(85, 100), 1)]
+        for _ in range(n)
+    ]
 
 class MqttPublisher:
-    def __init__(self, host="localhost", port=1883):
+    def __init__(self, host="localhost", port=1883, device_ids=DEVICE_IDS):
         self.host = host
         self.port = port
         self.connected = False
         self.running = False
+        self.loop = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._connack = None  # asyncio.Event while a connect on the loop awaits CONNACK
+        self._last_mid = None
+        
+        # Per-device state kept in parallel lists indexed by device position
+        self.device_ids = list(device_ids)
+        # Topics are formatted once but must stay str: paho 2.x publish() calls
+        # topic.encode() itself and fails on bytes
+        self._topics = [TOPIC_TEMPLATE.format(pi_id=PI_ID, device_id=d) for d in self.device_ids]
+        self._batches = [[] for _ in self.device_ids]
+        self._batch_started = [0.0] * len(self.device_ids)
+        
+        # Invariant fields are encoded once; only readings are encoded per publish
+        self._prefixes = [
+            _dumps({"device_id": d, "pi_id": PI_ID, "unit": "celsius"})[:-1]
+            for d in self.device_ids
+        ]
+        self._last_sec = 0
+        self._last_ts = ""
+        self._readings = []
+        self._reading_idx = 0
+        self._rng = np.random.default_rng() if np is not None else None
         
         # Create client with MQTT v3.1.1 (compatible with most brokers)
         self.client = mqtt.Client(
-            client_id=f"test-{PI_ID}-{DEVICE_ID}",
+            client_id=f"test-{PI_ID}-{self.device_ids[0]}",
             protocol=mqtt.MQTTv311,
             transport="tcp",
             userdata=None,
@@ -51,8 +126,9 @@ class MqttPublisher:
         self.client.on_publish = self.on_publish
         self.client.on_disconnect = self.on_disconnect
         
-        # Enable logging
-        self.client.enable_logger()
+        # MQTT_DEBUG routes paho's per-packet trace to the logging module
+        if os.getenv("MQTT_DEBUG"):
+            self.client.enable_logger()
 
     def on_connect(self, client, userdata, flags, rc, *args, **kwargs):
         """
@@ -65,14 +141,17 @@ class MqttPublisher:
         else:
             print(f"❌ Failed to connect, return code: {rc}")
             self.connected = False
+        if self._connack:
+            self._connack.set()
     
     def on_publish(self, client, userdata, mid, *args):
         """
         Handle publish callback for MQTT v3.1.1
         Signature: (client, userdata, mid)
         """
-        # For MQTT v3.1.1, we don't get reasonCode, just acknowledge
-        print(f"🟢 Message published (mid={mid})")
+        # Only the most recent batch is tracked; earlier acks are implied
+        if mid == self._last_mid:
+            print(f"🟢 Batch published (mid={mid})")
     
     def on_disconnect(self, client, userdata, rc, *args):
         """
@@ -84,76 +163,222 @@ class MqttPublisher:
             print(f"⚠️  Disconnected from broker, return code: {rc}")
         else:
             print("🔌 Disconnected from broker")
+        self._schedule_reconnect()
     
-    def connect(self):
-        """Connect to MQTT broker"""
+    def on_socket_open(self, client, userdata, sock):
+        """Register the new socket with the event loop for reads"""
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        """Unregister the socket and stop housekeeping"""
+        self.loop.remove_reader(sock)
+        if self._misc_task:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        """Paho has outgoing data queued - wait for the socket to be writable"""
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        """Outgoing queue drained - stop watching for writability"""
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        """Run paho's keepalive/retry housekeeping once per second"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                return
+        # MQTT_ERR_NO_CONN - the connection dropped under us
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        """Start reconnecting from the event loop unless already doing so"""
+        if self.running and self.loop and not self._reconnect_task:
+            self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self, min_delay=1, max_delay=60):
+        """Reconnect with exponential backoff on the event loop.
+        
+        Buffered readings stay in _batches and go out with the next flush.
+        """
+        delay = min_delay
         try:
-            print(f"Connecting to {self.host}:{self.port}...")
+            while self.running:
+                await asyncio.sleep(delay)
+                print(f"🔄 Reconnecting to {self.host}:{self.port}...")
+                # reconnect() reuses the host, port and timeout from connect()
+                if await self._await_connack(self.client.reconnect, 10):
+                    return
+                delay = min(delay * 2, max_delay)
+        finally:
+            self._reconnect_task = None
+
+    async def _await_connack(self, start, timeout):
+        """Call start() on the loop thread and wait for on_connect to report CONNACK.
+        
+        The socket callbacks are already installed, so on_socket_open hands the
+        new socket to the loop and no other thread ever touches the client.
+        """
+        self._connack = asyncio.Event()
+        try:
+            start()
+            await asyncio.wait_for(self._connack.wait(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._connack = None
+        return self.connected
+
+    def handshake(self, timeout=2):
+        """Blocking MQTT CONNECT/CONNACK - safe to run in a worker thread.
+        
+        Used by discovery before any event loop exists: no socket callbacks are
+        installed, so paho reads and writes directly here and connect() later
+        hands the live socket to the loop.
+        """
+        try:
+            self.client.connect_timeout = timeout
             self.client.connect(self.host, self.port, keepalive=60)
-            self.client.loop_start()  # Start background thread
-            
-            # Wait for connection
-            timeout = 10
-            start_time = time.time()
-            while not self.connected and (time.time() - start_time) < timeout:
-                time.sleep(0.1)
-            
-            if not self.connected:
-                print("❌ Connection timeout")
-                return False
-                
+            deadline = time.monotonic() + timeout
+            while not self.connected and time.monotonic() < deadline:
+                if self.client.loop(timeout=0.1) != mqtt.MQTT_ERR_SUCCESS:
+                    break
+        except Exception:
+            pass
+        return self.connected
+
+    def discard(self):
+        """Drop the connection quietly (unused discovery candidates)"""
+        self.client.on_disconnect = None
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+    def attach(self):
+        """Let the running asyncio event loop drive the socket instead of loop_start()"""
+        self.loop = asyncio.get_running_loop()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    async def connect(self, timeout=10):
+        """Connect to MQTT broker (unless discovery already did) on the event loop"""
+        self.attach()
+        if self.connected:
+            # Discovery's handshake opened the socket before the callbacks existed
+            sock = self.client.socket()
+            self.on_socket_open(self.client, None, sock)
+            if self.client.want_write():
+                self.on_socket_register_write(self.client, None, sock)
             return True
-        except Exception as e:
-            print(f"❌ Connection error: {e}")
+        
+        print(f"Connecting to {self.host}:{self.port}...")
+        self.client.connect_timeout = timeout
+        if not await self._await_connack(
+            lambda: self.client.connect(self.host, self.port, keepalive=60), timeout
+        ):
+            print("❌ Connection timeout")
+            self.discard()
             return False
+        return True
 
     def publish_temperature(self):
-        """Generate and publish temperature reading"""
-        if not self.connected:
+        """Generate and publish a temperature reading for every device"""
+        if not self.connected or self._reconnect_task:
             print("⚠️  Not connected, skipping publish")
             return False
         
-        # Generate realistic temperature reading
-        temp = BASE_TEMP + random.uniform(-TEMP_VARIATION, TEMP_VARIATION)
+        # Timestamp has second resolution - only reformat when the second changes
+        sec = int(time.time())
+        if sec != self._last_sec:
+            self._last_ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))
+            self._last_sec = sec
         
-        # Create payload
-        payload = {
-            "device_id": DEVICE_ID,
-            "pi_id": PI_ID,
-            "timestamp": datetime.now().isoformat(),
-            "temperature": round(temp, 2),
-            "unit": "celsius",
-            "humidity": round(random.uniform(40, 70), 1),  # Optional humidity
-            "battery": round(random.uniform(85, 100), 1)   # Optional battery l>
-        }
+        ok = True
+        for i in range(len(self.device_ids)):
+            ok = self.publish_for(i) and ok
+        return ok
+
+    def publish_for(self, i):
+        """Generate a reading for the device at index i and batch it"""
+        # Take the next pre-generated reading, refilling the buffer when empty
+        if self._reading_idx == len(self._readings):
+            self._readings = generate_readings(RANDOM_BATCH, self._rng)
+            self._reading_idx = 0
+        temp, humidity, battery = self._readings[self._reading_idx]
+        self._reading_idx += 1
+        
+        # Create payload - splice the variable fields onto the cached prefix
+        variable = _dumps({
+            "timestamp": self._last_ts,
+            "temperature": temp,
+            "humidity": humidity,  # Optional humidity
+            "battery": battery     # Optional battery l>
+        })
         
+        batch = self._batches[i]
+        if not batch:
+            self._batch_started[i] = time.monotonic()
+        batch.append(self._prefixes[i] + b"," + variable[1:])
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.device_ids[i]} Reading: {temp:.2f}°C")
+        
+        if len(batch) >= BATCH_SIZE or time.monotonic() - self._batch_started[i] >= FLUSH_INTERVAL:
+            return self.flush_batch(i)
+        return True
+
+    def flush_batch(self, i):
+        """Publish all buffered readings for the device at index i back-to-back
+
+        Each reading is its own QoS 1 message (the ingestor stores one row per
+        message); the acks are not awaited between publishes.
+        """
+        batch = self._batches[i]
+        if not batch:
+            return True
+        
+        sent = 0
         try:
-            # Publish with QoS 1 for reliability
-            result = self.client.publish(TOPIC, json.dumps(payload), qos=1)
+            for payload in batch:
+                # Publish with QoS 1 for reliability
+                result = self.client.publish(self._topics[i], payload, qos=1)
+                
+                # NO_CONN means paho queued the QoS 1 message and sends it after reconnecting
+                if result.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                    print(f"❌ Publish failed: {result.rc}")
+                    break
+                self._last_mid = result.mid
+                sent += 1
             
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] Publish: {temp:.2f}°C")
-                return True
-            else:
-                print(f"❌ Publish failed: {result.rc}")
-                return False
+            if sent:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.device_ids[i]} Publish: {sent} readings")
+            return sent == len(batch)
                 
         except Exception as e:
             print(f"❌ Publish error: {e}")
             return False
+        finally:
+            # Keep whatever was not handed to paho for the next flush
+            self._batches[i] = batch[sent:]
 
-    def start_publishing(self, interval=2):
+    async def start_publishing(self, interval=2):
         """Start publishing temperature readings at regular intervals"""
         self.running = True
-        print(f"📡 Publishing to topic: {TOPIC}")
+        for topic in self._topics:
+            print(f"📡 Publishing to topic: {topic}")
         print("Press Ctrl+C to stop...")
         
         try:
             while self.running:
                 self.publish_temperature()
-                time.sleep(interval)
+                await asyncio.sleep(interval)
                 
-        except KeyboardInterrupt:
+        except asyncio.CancelledError:
             print("\n🛑 Stopping...")
             self.running = False
         except Exception as e:
@@ -164,10 +389,17 @@ class MqttPublisher:
     def stop(self):
         """Stop the publisher and disconnect"""
         self.running = False
+        reconnecting = self._reconnect_task is not None
+        if reconnecting:
+            self._reconnect_task.cancel()
         try:
             if self.client:
-                self.client.loop_stop()   # Stop background thread first
+                if self.connected and not reconnecting:
+                    for i in range(len(self.device_ids)):
+                        self.flush_batch(i)
                 self.client.disconnect()
+                # Flush the DISCONNECT packet ourselves - the loop may be closing
+                self.client.loop_write()
         except Exception as e:
             print(f"⚠️  Error during shutdown: {e}")
         print("✅ Publisher stopped")
@@ -182,15 +414,26 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
-def test_broker_connection(host, port, timeout=3):
-    """Test if MQTT broker is reachable"""
+def resolve_host(host):
+    """Resolve a hostname to an IPv4 address (None if unknown)"""
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.settimeout(timeout)
-            result = sock.connect_ex((host, port))
-            return result == 0
-    except:
-        return False
+        return socket.gethostbyname(host)
+    except OSError:
+        return None
+
+def try_mqtt(host, ports, timeout=2):
+    """Attempt a full MQTT handshake on each port in turn; return the first connected publisher or None"""
+    for port in ports:
+        pub = MqttPublisher(host, port)
+        if pub.handshake(timeout):
+            return pub
+        pub.discard()
+    return None
+
+def _discard_candidate(future):
+    """Close a discovery connection that finished after the winner"""
+    if not future.cancelled() and future.exception() is None and future.result():
+        future.result().discard()
 
 def discover_broker():
     """Discover MQTT broker using multiple strategies"""
@@ -214,17 +457,61 @@ def discover_broker():
     
     print("Testing common hosts...")
     
+    # One candidate per broker address, whose ports are tried one after another.
+    # Every probe connects with the same client id, so two concurrent probes
+    # of one address (another name for it such as localhost, 127.0.0.1 or this
+    # machine's LAN IP, or another port of the same broker) would take over
+    # each other's session.
+    candidates = []
+    seen = set()
     for host in test_hosts:
-        for port in test_ports:
-            print(f"Testing {host}:{port}...", end=" ")
-            if test_broker_connection(host, port):
-                print("✅")
-                return host, port
+        addr = resolve_host(host)
+        if addr is None:
+            continue
+        if addr == local_ip or addr.startswith("127."):
+            addr = "127.0.0.1"
+        if addr not in seen:
+            seen.add(addr)
+            candidates.append(host)
+    if not candidates:
+        print("❌ No broker found. Please check your MQTT broker configuration.")
+        return None
+    
+    # Attempt an MQTT handshake with every address at once - a CONNACK proves
+    # a broker is there and the winning connection is kept for publishing
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {
+        executor.submit(try_mqtt, host, test_ports): n
+        for n, host in enumerate(candidates)
+    }
+    order = list(futures)
+    results = {}
+    winner = None
+    try:
+        for future in as_completed(futures):
+            n = futures[future]
+            results[n] = future.result()
+            if results[n]:
+                print(f"Testing {candidates[n]}:{results[n].port}... ✅")
             else:
-                print("❌")
+                print(f"Testing {candidates[n]}... ❌")
+            
+            # Keep the list's preference order: take the first success once
+            # every candidate ahead of it has failed
+            for k in range(len(candidates)):
+                if k not in results:
+                    break
+                if results[k]:
+                    winner = order[k]
+                    return results[k]
+    finally:
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(_discard_candidate)
+        executor.shutdown(wait=False, cancel_futures=True)
     
     print("❌ No broker found. Please check your MQTT broker configuration.")
-    return None, None
+    return None
 
 def main():
     """Main function"""
@@ -232,23 +519,30 @@ def main():
     print("Raspberry Pi MQTT Test Translator")
     print("=" * 60)
     
-    # Discover broker
-    host, port = discover_broker()
-    if not host:
+    # Discover broker - the returned publisher is already connected
+    pub = discover_broker()
+    if not pub:
         print("❌ Cannot find MQTT broker")
         return 1
     
-    print(f"✅ Found MQTT broker at {host}:{port}")
+    print(f"✅ Found MQTT broker at {pub.host}:{pub.port}")
     
-    # Create and start publisher
-    pub = MqttPublisher(host, port)
+    # uvloop.run creates its own loop without touching the global loop policy
+    run = uvloop.run if uvloop else asyncio.run
     
-    if not pub.connect():
+    try:
+        return run(run_publisher(pub))
+    except KeyboardInterrupt:
+        return 0
+
+async def run_publisher(pub, interval=2):
+    """Connect and publish on a single asyncio event loop"""
+    if not await pub.connect():
         print("❌ Failed to connect to broker")
         return 1
     
     # Start publishing
-    pub.start_publishing(interval=2)
+    await pub.start_publishing(interval=interval)
     
     return 0
 